@@ -0,0 +1,97 @@
+"""
+DICOM File Scanning Helpers
+
+Shared by find_chest_scans.py and list_dicom_info.py: finding .dcm files,
+reading only the tags needed from each, and mapping a function over chunks
+of files in a worker with optional readahead.
+"""
+
+import logging
+import os
+from typing import Optional
+
+import pydicom
+from pydicom.filereader import read_partial
+
+logger = logging.getLogger(__name__)
+
+
+def read_tags(dcm_file: str, tags: list) -> Optional[pydicom.Dataset]:
+    """
+    Read only the given (sorted) tags, stopping after the last one
+    
+    Returns None without invoking the parser if the file lacks the 'DICM'
+    prefix after its 128-byte preamble.
+    """
+    last_tag = tags[-1]
+    with open(dcm_file, 'rb') as fp:
+        fp.seek(128)
+        if fp.read(4) != b'DICM':
+            return None
+        fp.seek(0)
+        return read_partial(
+            fp,
+            stop_when=lambda tag, vr, length: tag > last_tag,
+            specific_tags=tags
+        )
+
+
+def tag_value(ds: pydicom.Dataset, tag, default: str = '') -> str:
+    """Return a tag's value as a stripped string, or default if it is absent"""
+    elem = ds.get(tag)
+    if elem is None:
+        return default
+    value = elem.value
+    return str(value).strip() if value is not None else ''
+
+
+def _readahead(path: str):
+    """Hint the kernel to start reading path into the page cache"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
+
+
+def map_chunk(func, paths: list, readahead: int = 0) -> list:
+    """
+    Apply func to each path of a chunk in a worker
+    
+    With readahead > 0, the next `readahead` files of the chunk are hinted
+    to the kernel while the current one is parsed, so reads are pipelined
+    instead of stalling on each open (mostly useful on NFS/SMB).
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        readahead = 0
+    for path in paths[:readahead]:
+        _readahead(path)
+    
+    results = []
+    for idx, path in enumerate(paths):
+        if readahead and idx + readahead < len(paths):
+            _readahead(paths[idx + readahead])
+        results.append(func(path))
+    return results
+
+
+def scandir_dcm(path: str):
+    """
+    Recursively yield os.DirEntry objects for .dcm files under path
+    
+    Directories that cannot be read are skipped with a warning.
+    """
+    try:
+        it = os.scandir(path)
+    except OSError as e:
+        logger.warning(f"Skipping unreadable directory {path}: {e}")
+        return
+    with it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                yield from scandir_dcm(entry.path)
+            elif entry.name.endswith('.dcm') and entry.is_file():
+                yield entry
@@ -7,163 +7,346 @@ DICOM tags like BodyPartExamined, SeriesDescription, and StudyDescription.
 """
 
 import argparse
+import csv
 import logging
+import os
+import re
 from pathlib import Path
-from typing import List, Dict
+from typing import List, Dict, Optional
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import chain
+from functools import lru_cache, partial
 import shutil
 
 try:
-    import pydicom
-    import pandas as pd
+    from pydicom.tag import Tag
+    from dicom_scan import map_chunk, read_tags, scandir_dcm, tag_value
 except ImportError:
     print("Error: Required packages not installed. Install with:")
-    print("  pip install pydicom pandas")
+    print("  pip install pydicom")
     import sys
     sys.exit(1)
 
+try:
+    # Optional: pip install pyahocorasick (falls back to a compiled regex)
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+try:
+    import fcntl
+except ImportError:  # Windows: no reflink support
+    fcntl = None
+
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
 
+# Number of files handed to a worker at once
+CHUNK_SIZE = 64
+
+# Tags read by is_chest_scan, looked up by number rather than by keyword
+_TAG_MODALITY = Tag(0x0008, 0x0060)
+_TAG_STUDY_DESCRIPTION = Tag(0x0008, 0x1030)
+_TAG_SERIES_DESCRIPTION = Tag(0x0008, 0x103E)
+_TAG_PATIENT_ID = Tag(0x0010, 0x0020)
+_TAG_BODY_PART_EXAMINED = Tag(0x0018, 0x0015)
+_TAG_STUDY_INSTANCE_UID = Tag(0x0020, 0x000D)
+_TAG_SERIES_INSTANCE_UID = Tag(0x0020, 0x000E)
+_TAG_SERIES_NUMBER = Tag(0x0020, 0x0011)
+
+# Sorted in file order so the parser can stop as soon as the last one has
+# been passed
+_CHEST_TAGS = sorted((
+    _TAG_MODALITY, _TAG_STUDY_DESCRIPTION, _TAG_SERIES_DESCRIPTION,
+    _TAG_PATIENT_ID, _TAG_BODY_PART_EXAMINED, _TAG_STUDY_INSTANCE_UID,
+    _TAG_SERIES_INSTANCE_UID, _TAG_SERIES_NUMBER,
+))
+
+# ioctl request cloning a whole file (FICLONE from linux/fs.h), used for
+# copy-on-write reflinks on Btrfs/XFS
+_FICLONE = 0x40049409
+
+# Columns of the CSV report, in order
+REPORT_FIELDS = [
+    'file', 'patient_id', 'study_uid', 'series_uid', 'series_number',
+    'modality', 'body_part', 'series_desc', 'study_desc',
+    'matched_on', 'matched_text',
+]
+
+
+@lru_cache(maxsize=None)
+def _keyword_matcher(keywords: tuple):
+    """
+    Build a matcher looking for all keywords in a single pass over a text
+    
+    Built once per worker process. Returns a callable giving a truthy value
+    if the text contains any keyword, ignoring case, None otherwise.
+    """
+    if ahocorasick is not None:
+        automaton = ahocorasick.Automaton()
+        for keyword in keywords:
+            automaton.add_word(keyword, keyword)
+        automaton.make_automaton()
+        return lambda text: next(automaton.iter(text.lower()), None)
+    
+    # A literal alternation is scanned in C; IGNORECASE saves lowercasing
+    # every text beforehand
+    return re.compile('|'.join(map(re.escape, keywords)), re.IGNORECASE).search
+
+
+def _reflink(src: Path, dst: Path):
+    """
+    Clone src into dst sharing extents; raises OSError where unsupported
+    
+    dst must not exist: it is created exclusively, so that an existing link
+    to src is never opened and truncated.
+    """
+    with open(src, 'rb') as fsrc:
+        fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        with open(fd, 'wb') as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+            except OSError:
+                os.unlink(dst)
+                raise
+
+
+def _copy_file(src: Path, dst: Path, mode: str = 'copy', preserve_metadata: bool = False):
+    """
+    Copy, link or clone a single file
+    
+    Args:
+        mode: 'copy', 'hardlink', 'symlink' or 'reflink' (falls back to a
+              plain copy when the filesystem cannot clone)
+        preserve_metadata: Also copy permissions and timestamps (copy2 behaviour)
+    """
+    if mode in ('hardlink', 'symlink'):
+        link = os.link if mode == 'hardlink' else os.symlink
+        target = src if mode == 'hardlink' else src.resolve()
+        try:
+            link(target, dst)
+        except FileExistsError:
+            dst.unlink()
+            link(target, dst)
+        return
+    
+    # A previous run may have left a hardlink or symlink to src at dst:
+    # writing through it would truncate the source file
+    if os.path.lexists(dst):
+        dst.unlink()
+    
+    cloned = False
+    if mode == 'reflink' and fcntl is not None:
+        try:
+            _reflink(src, dst)
+            cloned = True
+        except OSError as e:
+            logger.debug(f"Reflink failed for {src} ({e}), copying instead")
+    
+    if not cloned:
+        # copyfile uses sendfile() on Linux, keeping the data in the kernel
+        shutil.copyfile(src, dst)
+    if preserve_metadata:
+        shutil.copystat(src, dst)
+
+
+def is_chest_scan(dcm_file: str, keywords: tuple) -> Optional[Dict]:
+    """
+    Check if DICOM file is a chest scan
+    
+    Module-level so it can be dispatched to worker processes. The report
+    text (matched_text, lowercased fields) is only built for files that
+    match.
+    
+    Returns:
+        Dict with file info and matching criteria, or None if not a chest scan
+    """
+    try:
+        ds = read_tags(dcm_file, _CHEST_TAGS)
+        if ds is None:
+            logger.warning(f"Skipping {dcm_file}: not a DICOM file")
+            return None
+        
+        # Extract relevant tags; matching ignores case, so text fields are
+        # only lowercased for the report once a match is found
+        body_part = tag_value(ds, _TAG_BODY_PART_EXAMINED)
+        series_desc = tag_value(ds, _TAG_SERIES_DESCRIPTION)
+        study_desc = tag_value(ds, _TAG_STUDY_DESCRIPTION)
+        
+        # Nothing to match in files without any description
+        if not (body_part or series_desc or study_desc):
+            return None
+        
+        modality = tag_value(ds, _TAG_MODALITY).upper()
+        patient_id = tag_value(ds, _TAG_PATIENT_ID, 'UNKNOWN')
+        study_uid = tag_value(ds, _TAG_STUDY_INSTANCE_UID, 'UNKNOWN')
+        series_uid = tag_value(ds, _TAG_SERIES_INSTANCE_UID, 'UNKNOWN')
+        series_number = tag_value(ds, _TAG_SERIES_NUMBER)
+        
+        # Check for chest keywords
+        search = _keyword_matcher(keywords)
+        matches = []
+        for field, label, text in (
+            ('BodyPartExamined', 'BodyPart', body_part),
+            ('SeriesDescription', 'Series', series_desc),
+            ('StudyDescription', 'Study', study_desc),
+        ):
+            if text and search(text):
+                matches.append((field, label, text))
+        
+        # If any match found, return info
+        if matches:
+            return {
+                'file': str(dcm_file),
+                'patient_id': patient_id,
+                'study_uid': study_uid,
+                'series_uid': series_uid,
+                'series_number': series_number,
+                'modality': modality,
+                'body_part': body_part.lower(),
+                'series_desc': series_desc.lower(),
+                'study_desc': study_desc.lower(),
+                'matched_on': ', '.join(field for field, _, _ in matches),
+                'matched_text': ' | '.join(f"{label}: {text.lower()}" for _, label, text in matches)
+            }
+        
+        return None
+        
+    except Exception as e:
+        logger.warning(f"Error reading {dcm_file}: {e}")
+        return None
+
 
 class ChestScanFinder:
     """Find chest/thorax scintigraphy scans in DICOM files"""
     
     # Keywords to identify chest scans (case-insensitive)
-    CHEST_KEYWORDS = [
+    CHEST_KEYWORDS = (
         'chest', 'thorax', 'lung', 'pulmonary', 
         'ventilation', 'perfusion', 'v/q', 'vq',
         'heart', 'myocardial', 'cardiac', 'coronary',
         'poumon', 'thoracique', 'cardiaque'  # French keywords
-    ]
+    )
     
-    def __init__(self, input_dir: str):
+    def __init__(
+        self,
+        input_dir: str,
+        workers: Optional[int] = None,
+        use_threads: bool = False,
+        readahead: int = 32,
+        one_per_series: bool = False
+    ):
         self.input_dir = Path(input_dir)
         if not self.input_dir.exists():
             raise ValueError(f"Directory does not exist: {input_dir}")
         
+        self.workers = workers or os.cpu_count()
+        self.use_threads = use_threads
+        self.readahead = readahead
+        self.one_per_series = one_per_series
+        self.keywords = self.CHEST_KEYWORDS
+        self.total_files = 0
         self.results = []
-    
-    def is_chest_scan(self, dcm_file: Path) -> Dict:
-        """
-        Check if DICOM file is a chest scan
         
-        Returns:
-            Dict with file info and matching criteria, or None if not a chest scan
-        """
-        try:
-            ds = pydicom.dcmread(dcm_file, stop_before_pixels=True)
-            
-            # Extract relevant tags
-            body_part = str(getattr(ds, 'BodyPartExamined', '')).lower()
-            series_desc = str(getattr(ds, 'SeriesDescription', '')).lower()
-            study_desc = str(getattr(ds, 'StudyDescription', '')).lower()
-            modality = str(getattr(ds, 'Modality', '')).upper()
-            patient_id = str(getattr(ds, 'PatientID', 'UNKNOWN'))
-            study_uid = str(getattr(ds, 'StudyInstanceUID', 'UNKNOWN'))
-            series_uid = str(getattr(ds, 'SeriesInstanceUID', 'UNKNOWN'))
-            series_number = str(getattr(ds, 'SeriesNumber', ''))
-            
-            # Check for chest keywords
-            matches = []
-            matched_text = []
-            
-            for keyword in self.CHEST_KEYWORDS:
-                if keyword in body_part:
-                    matches.append('BodyPartExamined')
-                    matched_text.append(f"BodyPart: {body_part}")
-                    break
-            
-            for keyword in self.CHEST_KEYWORDS:
-                if keyword in series_desc:
-                    matches.append('SeriesDescription')
-                    matched_text.append(f"Series: {series_desc}")
-                    break
-            
-            for keyword in self.CHEST_KEYWORDS:
-                if keyword in study_desc:
-                    matches.append('StudyDescription')
-                    matched_text.append(f"Study: {study_desc}")
-                    break
-            
-            # If any match found, return info
-            if matches:
-                return {
-                    'file': str(dcm_file),
-                    'patient_id': patient_id,
-                    'study_uid': study_uid,
-                    'series_uid': series_uid,
-                    'series_number': series_number,
-                    'modality': modality,
-                    'body_part': body_part,
-                    'series_desc': series_desc,
-                    'study_desc': study_desc,
-                    'matched_on': ', '.join(matches),
-                    'matched_text': ' | '.join(matched_text)
-                }
-            
-            return None
-            
-        except Exception as e:
-            logger.warning(f"Error reading {dcm_file}: {e}")
-            return None
+        # Summary aggregates, updated as matches are written
+        self.patients = set()
+        self.studies = set()
+        self.series = set()
     
-    def scan_directory(self) -> List[Dict]:
-        """Scan directory for chest scans"""
+    def scan_directory(self, output_file: str) -> List[Dict]:
+        """Scan directory for chest scans, writing report rows as they are found"""
         logger.info(f"Scanning directory: {self.input_dir}")
         
         # Find all DICOM files
-        dcm_files = list(self.input_dir.rglob('*.dcm'))
-        logger.info(f"Found {len(dcm_files)} DICOM files")
+        dcm_files = [entry.path for entry in scandir_dcm(str(self.input_dir))]
+        total = self.total_files = len(dcm_files)
+        logger.info(f"Found {total} DICOM files")
         
         if not dcm_files:
             logger.warning("No DICOM files found!")
             return []
         
-        # Check each file
+        # Check files in parallel; threads are better on network filesystems
+        # where reads dominate, processes when header parsing is CPU-bound
+        executor_cls = ThreadPoolExecutor if self.use_threads else ProcessPoolExecutor
+        
+        # With one series per directory (PatientID/StudyUID/SeriesUID/), only
+        # the first file of each directory needs parsing: its verdict and
+        # tags apply to all of its siblings
+        if self.one_per_series:
+            series_dirs = {}
+            for path in dcm_files:
+                series_dirs.setdefault(os.path.dirname(path), []).append(path)
+            groups = list(series_dirs.values())
+            to_check = [files[0] for files in groups]
+            logger.info(f"Checking one file in each of {len(to_check)} series directories")
+        else:
+            groups = None
+            to_check = dcm_files
+        
+        check = partial(
+            map_chunk, partial(is_chest_scan, keywords=self.keywords), readahead=self.readahead
+        )
+        chunks = [to_check[i:i + CHUNK_SIZE] for i in range(0, len(to_check), CHUNK_SIZE)]
+        
         chest_scans = []
-        for idx, dcm_file in enumerate(dcm_files, 1):
-            if idx % 100 == 0:
-                logger.info(f"Processed {idx}/{len(dcm_files)} files...")
+        with open(output_file, 'w', newline='') as report, \
+                executor_cls(max_workers=self.workers) as executor:
+            writer = csv.DictWriter(report, fieldnames=REPORT_FIELDS, lineterminator='\n')
+            writer.writeheader()
             
-            result = self.is_chest_scan(dcm_file)
-            if result:
-                chest_scans.append(result)
-                logger.info(f"✓ Found chest scan: {result['matched_text']}")
+            results = chain.from_iterable(executor.map(check, chunks))
+            for idx, result in enumerate(results, 1):
+                if idx % 100 == 0:
+                    logger.info(f"Processed {idx}/{len(to_check)} files...")
+                
+                if result:
+                    rows = [result]
+                    if groups:
+                        rows += [dict(result, file=path) for path in groups[idx - 1][1:]]
+                    writer.writerows(rows)
+                    chest_scans.extend(rows)
+                    self.patients.add(result['patient_id'])
+                    self.studies.add(result['study_uid'])
+                    self.series.add(result['series_uid'])
+                    logger.info(f"✓ Found chest scan: {result['matched_text']}")
         
-        logger.info(f"Found {len(chest_scans)} chest scans out of {len(dcm_files)} files")
+        logger.info(f"Found {len(chest_scans)} chest scans out of {total} files")
+        logger.info(f"Report saved to: {output_file}")
         self.results = chest_scans
         return chest_scans
     
-    def save_report(self, output_file: str):
-        """Save results to CSV file"""
+    def print_summary(self):
+        """Print a summary of the scan results"""
         if not self.results:
-            logger.warning("No results to save")
+            logger.warning("No results to summarize")
             return
         
-        df = pd.DataFrame(self.results)
-        df.to_csv(output_file, index=False)
-        logger.info(f"Report saved to: {output_file}")
-        
-        # Print summary
         print("\n" + "="*80)
         print("SUMMARY")
         print("="*80)
-        print(f"Total DICOM files scanned: {len(list(self.input_dir.rglob('*.dcm')))}")
+        print(f"Total DICOM files scanned: {self.total_files}")
         print(f"Chest scans found: {len(self.results)}")
-        print(f"\nUnique patients: {df['patient_id'].nunique()}")
-        print(f"Unique studies: {df['study_uid'].nunique()}")
-        print(f"Unique series: {df['series_uid'].nunique()}")
+        print(f"\nUnique patients: {len(self.patients)}")
+        print(f"Unique studies: {len(self.studies)}")
+        print(f"Unique series: {len(self.series)}")
         
-        if len(self.results) > 0:
-            print(f"\nSample descriptions:")
-            for _, row in df.head(5).iterrows():
-                print(f"  - {row['series_desc']}")
+        print(f"\nSample descriptions:")
+        for result in self.results[:5]:
+            print(f"  - {result['series_desc']}")
     
-    def copy_chest_scans(self, output_dir: str):
-        """Copy chest scan files to separate directory"""
+    def copy_chest_scans(self, output_dir: str, mode: str = 'copy', preserve_metadata: bool = False):
+        """
+        Copy chest scan files to separate directory
+        
+        Args:
+            output_dir: Destination directory
+            mode: 'copy', 'hardlink', 'symlink' or 'reflink'
+            preserve_metadata: Also copy permissions and timestamps
+        """
         if not self.results:
             logger.warning("No chest scans to copy")
             return
@@ -171,16 +354,19 @@ class ChestScanFinder:
         output_path = Path(output_dir)
         output_path.mkdir(parents=True, exist_ok=True)
         
-        logger.info(f"Copying {len(self.results)} chest scans to {output_dir}")
+        logger.info(f"Copying {len(self.results)} chest scans to {output_dir} (mode: {mode})")
         
+        created_dirs = set()
         for result in self.results:
             src = Path(result['file'])
             # Preserve directory structure: PatientID/StudyUID/SeriesUID/
             rel_path = src.relative_to(self.input_dir)
             dst = output_path / rel_path
             
-            dst.parent.mkdir(parents=True, exist_ok=True)
-            shutil.copy2(src, dst)
+            if dst.parent not in created_dirs:
+                dst.parent.mkdir(parents=True, exist_ok=True)
+                created_dirs.add(dst.parent)
+            _copy_file(src, dst, mode=mode, preserve_metadata=preserve_metadata)
         
         logger.info(f"Copied {len(self.results)} files to {output_dir}")
 
@@ -197,6 +383,12 @@ Examples:
   # Scan and copy chest scans to separate directory
   %(prog)s -i ./nm_images -o chest_scans_report.csv --copy-to ./chest_scans
   
+  # Hardlink instead of copying (same filesystem, no extra disk space)
+  %(prog)s -i ./nm_images -o chest_scans_report.csv --copy-to ./chest_scans --copy-mode hardlink
+  
+  # Parse only one file per series directory (much faster on large archives)
+  %(prog)s -i ./nm_images -o chest_scans_report.csv --one-per-series
+  
   # Scan with custom keywords
   %(prog)s -i ./nm_images -o report.csv --keywords "poumon,thorax,cardiaque"
         '''
@@ -216,10 +408,44 @@ Examples:
         '--copy-to',
         help='Copy chest scan files to this directory'
     )
+    parser.add_argument(
+        '--copy-mode',
+        choices=['copy', 'hardlink', 'reflink', 'symlink'],
+        default='copy',
+        help='How to place files with --copy-to: copy (default), hardlink, '
+             'reflink (copy-on-write clone, falls back to copy) or symlink'
+    )
+    parser.add_argument(
+        '--preserve-metadata',
+        action='store_true',
+        help='Preserve permissions and timestamps when copying'
+    )
     parser.add_argument(
         '--keywords',
         help='Additional keywords to search for (comma-separated)'
     )
+    parser.add_argument(
+        '--one-per-series',
+        action='store_true',
+        help='Read only the first file of each directory and apply the result '
+             'to the whole directory (assumes one series per directory)'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        help='Number of parallel workers (default: number of CPUs)'
+    )
+    parser.add_argument(
+        '--threads',
+        action='store_true',
+        help='Use threads instead of processes (faster on network filesystems)'
+    )
+    parser.add_argument(
+        '--readahead',
+        type=int,
+        default=32,
+        help='Number of upcoming files to prefetch per worker, 0 to disable (default: 32)'
+    )
     parser.add_argument(
         '--debug',
         action='store_true',
@@ -232,24 +458,33 @@ Examples:
         logging.getLogger().setLevel(logging.DEBUG)
     
     # Create finder
-    finder = ChestScanFinder(args.input)
+    finder = ChestScanFinder(
+        args.input,
+        workers=args.workers,
+        use_threads=args.threads,
+        readahead=args.readahead,
+        one_per_series=args.one_per_series
+    )
     
     # Add custom keywords if provided
     if args.keywords:
-        custom_keywords = [kw.strip().lower() for kw in args.keywords.split(',')]
-        finder.CHEST_KEYWORDS.extend(custom_keywords)
+        custom_keywords = [kw.strip().lower() for kw in args.keywords.split(',') if kw.strip()]
+        finder.keywords += tuple(custom_keywords)
         logger.info(f"Added custom keywords: {custom_keywords}")
     
-    # Scan directory
-    finder.scan_directory()
+    # Scan directory, writing the report as matches are found
+    finder.scan_directory(args.output)
     
-    # Save report
     if finder.results:
-        finder.save_report(args.output)
+        finder.print_summary()
         
         # Copy files if requested
         if args.copy_to:
-            finder.copy_chest_scans(args.copy_to)
+            finder.copy_chest_scans(
+                args.copy_to,
+                mode=args.copy_mode,
+                preserve_metadata=args.preserve_metadata
+            )
     else:
         logger.warning("No chest scans found!")
 
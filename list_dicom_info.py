@@ -8,16 +8,24 @@ Generates a CSV report with all information.
 
 import argparse
 import logging
+import os
+from collections import Counter, namedtuple
 from pathlib import Path
-from typing import List, Dict
+from typing import Optional
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import chain
+from functools import partial
 
 try:
-    import pydicom
-    import pandas as pd
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    from pyarrow import csv as pacsv
+    from pydicom.tag import Tag
+    from dicom_scan import map_chunk, read_tags, scandir_dcm, tag_value
 except ImportError:
     print("Error: Required packages not installed. Install with:")
-    print("  pip install pydicom pandas")
+    print("  pip install pydicom pyarrow")
     import sys
     sys.exit(1)
 
@@ -27,229 +35,357 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Tags read by extract_info, looked up by number rather than by keyword
+_TAG_PATIENT_NAME = Tag(0x0010, 0x0010)
+_TAG_PATIENT_ID = Tag(0x0010, 0x0020)
+_TAG_PATIENT_BIRTH_DATE = Tag(0x0010, 0x0030)
+_TAG_PATIENT_SEX = Tag(0x0010, 0x0040)
+_TAG_STUDY_DATE = Tag(0x0008, 0x0020)
+_TAG_SERIES_DATE = Tag(0x0008, 0x0021)
+_TAG_ACQUISITION_DATE = Tag(0x0008, 0x0022)
+_TAG_CONTENT_DATE = Tag(0x0008, 0x0023)
+_TAG_STUDY_TIME = Tag(0x0008, 0x0030)
+_TAG_SERIES_TIME = Tag(0x0008, 0x0031)
+_TAG_ACQUISITION_TIME = Tag(0x0008, 0x0032)
+_TAG_MODALITY = Tag(0x0008, 0x0060)
+_TAG_INSTITUTION_NAME = Tag(0x0008, 0x0080)
+_TAG_STUDY_DESCRIPTION = Tag(0x0008, 0x1030)
+_TAG_SERIES_DESCRIPTION = Tag(0x0008, 0x103E)
+_TAG_BODY_PART_EXAMINED = Tag(0x0018, 0x0015)
+_TAG_STUDY_INSTANCE_UID = Tag(0x0020, 0x000D)
+_TAG_SERIES_INSTANCE_UID = Tag(0x0020, 0x000E)
+_TAG_SERIES_NUMBER = Tag(0x0020, 0x0011)
+_TAG_INSTANCE_NUMBER = Tag(0x0020, 0x0013)
+
+# Sorted in file order so the parser can stop as soon as the last one has
+# been passed
+_INFO_TAGS = sorted((
+    _TAG_PATIENT_NAME, _TAG_PATIENT_ID, _TAG_PATIENT_BIRTH_DATE, _TAG_PATIENT_SEX,
+    _TAG_STUDY_DATE, _TAG_SERIES_DATE, _TAG_ACQUISITION_DATE, _TAG_CONTENT_DATE,
+    _TAG_STUDY_TIME, _TAG_SERIES_TIME, _TAG_ACQUISITION_TIME,
+    _TAG_MODALITY, _TAG_INSTITUTION_NAME, _TAG_STUDY_DESCRIPTION,
+    _TAG_SERIES_DESCRIPTION, _TAG_BODY_PART_EXAMINED,
+    _TAG_STUDY_INSTANCE_UID, _TAG_SERIES_INSTANCE_UID,
+    _TAG_SERIES_NUMBER, _TAG_INSTANCE_NUMBER,
+))
+
+# Columns of the CSV report, in order
+REPORT_FIELDS = [
+    'file_path', 'patient_name', 'patient_id', 'patient_sex', 'patient_birth_date',
+    'observation_date', 'observation_time', 'observation_date_raw',
+    'examined_area', 'body_part', 'study_description', 'series_description',
+    'modality', 'institution', 'study_uid', 'series_uid',
+    'series_number', 'instance_number',
+]
+MINIMAL_FIELDS = ['patient_name', 'observation_date', 'examined_area', 'file_path']
+
+# Low-cardinality columns, written dictionary-encoded so each batch holds
+# every distinct value only once
+DICTIONARY_FIELDS = {'patient_sex', 'modality', 'body_part', 'institution'}
+
+# One report row; a tuple in REPORT_FIELDS order
+ReportRow = namedtuple('ReportRow', REPORT_FIELDS)
+
+# Number of files handed to a worker at once
+CHUNK_SIZE = 64
+
+# Number of rows buffered before being written as one Arrow record batch
+BATCH_SIZE = 10_000
+
+
+def _format_dates(dates: pa.Array) -> pa.Array:
+    """Format a column of DICOM dates (YYYYMMDD) to readable format"""
+    formatted = pc.binary_join_element_wise(
+        pc.utf8_slice_codeunits(dates, 6, 8),
+        pc.utf8_slice_codeunits(dates, 4, 6),
+        pc.utf8_slice_codeunits(dates, 0, 4),
+        '/'
+    )
+    return pc.if_else(pc.greater_equal(pc.utf8_length(dates), 8), formatted, dates)
+
+
+def _format_times(times: pa.Array) -> pa.Array:
+    """Format a column of DICOM times (HHMMSS.FFFFFF) to readable format"""
+    formatted = pc.binary_join_element_wise(
+        pc.utf8_slice_codeunits(times, 0, 2),
+        pc.utf8_slice_codeunits(times, 2, 4),
+        pc.utf8_slice_codeunits(times, 4, 6),
+        ':'
+    )
+    return pc.if_else(pc.greater_equal(pc.utf8_length(times), 6), formatted, times)
+
+
+# Columns extracted raw and formatted a whole batch at a time when written
+_COLUMN_FORMATTERS = {
+    'patient_birth_date': _format_dates,
+    'observation_date': _format_dates,
+    'observation_time': _format_times,
+}
+
+
+def anonymize_name(name: str, patient_id: str) -> str:
+    """Anonymize patient name using patient ID"""
+    if not name or name == '':
+        return f"Patient_{patient_id}" if patient_id else "UNKNOWN"
+    return f"Patient_{patient_id}"
+
+
+def _error_row(dcm_file: str, message: str) -> ReportRow:
+    """Report row for a file that could not be read"""
+    return ReportRow(
+        dcm_file, 'ERROR', 'ERROR', '', '', '', '', '',
+        f'ERROR: {message}', '', '', '', '', '', '', '', '', '',
+    )
+
+
+def extract_info(dcm_file: str, anonymize: bool = False) -> ReportRow:
+    """
+    Extract patient, date, and body part information from DICOM file
+    
+    Module-level so it can be dispatched to worker processes.
+    
+    Returns:
+        ReportRow with extracted information
+    """
+    try:
+        ds = read_tags(dcm_file, _INFO_TAGS)
+        if ds is None:
+            logger.warning(f"Skipping {dcm_file}: not a DICOM file")
+            return _error_row(dcm_file, 'Not a DICOM file (missing DICM prefix)')
+        
+        # Extract patient information
+        patient_name = tag_value(ds, _TAG_PATIENT_NAME)
+        patient_id = tag_value(ds, _TAG_PATIENT_ID, 'UNKNOWN')
+        patient_birth_date = tag_value(ds, _TAG_PATIENT_BIRTH_DATE)
+        patient_sex = tag_value(ds, _TAG_PATIENT_SEX)
+        
+        # Anonymize if requested
+        if anonymize and patient_name:
+            display_name = anonymize_name(patient_name, patient_id)
+        else:
+            display_name = patient_name if patient_name else patient_id
+        
+        # Extract dates (try multiple date fields)
+        study_date = tag_value(ds, _TAG_STUDY_DATE)
+        series_date = tag_value(ds, _TAG_SERIES_DATE)
+        acquisition_date = tag_value(ds, _TAG_ACQUISITION_DATE)
+        content_date = tag_value(ds, _TAG_CONTENT_DATE)
+        
+        # Use the first available date
+        observation_date = study_date or series_date or acquisition_date or content_date
+        
+        # Extract times
+        study_time = tag_value(ds, _TAG_STUDY_TIME)
+        series_time = tag_value(ds, _TAG_SERIES_TIME)
+        acquisition_time = tag_value(ds, _TAG_ACQUISITION_TIME)
+        
+        observation_time = study_time or series_time or acquisition_time
+        
+        # Extract body part and descriptions
+        body_part = tag_value(ds, _TAG_BODY_PART_EXAMINED)
+        study_desc = tag_value(ds, _TAG_STUDY_DESCRIPTION)
+        series_desc = tag_value(ds, _TAG_SERIES_DESCRIPTION)
+        
+        # Combine descriptions for examined area
+        examined_area = body_part
+        if study_desc and study_desc not in examined_area:
+            examined_area = f"{body_part} - {study_desc}" if body_part else study_desc
+        if series_desc and series_desc not in examined_area:
+            examined_area = f"{examined_area} - {series_desc}" if examined_area else series_desc
+        
+        # Extract additional metadata
+        modality = tag_value(ds, _TAG_MODALITY)
+        institution = tag_value(ds, _TAG_INSTITUTION_NAME)
+        study_uid = tag_value(ds, _TAG_STUDY_INSTANCE_UID)
+        series_uid = tag_value(ds, _TAG_SERIES_INSTANCE_UID)
+        series_number = tag_value(ds, _TAG_SERIES_NUMBER)
+        instance_number = tag_value(ds, _TAG_INSTANCE_NUMBER)
+        
+        # Dates and times are left raw here and formatted per batch on write
+        return ReportRow(
+            dcm_file,
+            display_name,
+            patient_id,
+            patient_sex,
+            patient_birth_date,
+            observation_date,
+            observation_time,
+            observation_date,
+            examined_area,
+            body_part,
+            study_desc,
+            series_desc,
+            modality,
+            institution,
+            study_uid,
+            series_uid,
+            series_number,
+            instance_number,
+        )
+        
+    except Exception as e:
+        logger.warning(f"Error reading {dcm_file}: {e}")
+        return _error_row(dcm_file, str(e))
+
 
 class DicomInfoLister:
     """Extract patient, date, and body part information from DICOM files"""
     
-    def __init__(self, input_dir: str, anonymize: bool = False):
+    def __init__(
+        self,
+        input_dir: str,
+        anonymize: bool = False,
+        workers: Optional[int] = None,
+        use_threads: bool = False,
+        readahead: int = 32
+    ):
         self.input_dir = Path(input_dir)
         if not self.input_dir.exists():
             raise ValueError(f"Directory does not exist: {input_dir}")
         
         self.anonymize = anonymize
-        self.results = []
-    
-    def format_date(self, date_str: str) -> str:
-        """Format DICOM date (YYYYMMDD) to readable format"""
-        if not date_str or date_str == '':
-            return ''
-        try:
-            # DICOM date format is YYYYMMDD
-            if len(date_str) >= 8:
-                year = date_str[0:4]
-                month = date_str[4:6]
-                day = date_str[6:8]
-                return f"{day}/{month}/{year}"
-            return date_str
-        except:
-            return date_str
-    
-    def format_time(self, time_str: str) -> str:
-        """Format DICOM time (HHMMSS) to readable format"""
-        if not time_str or time_str == '':
-            return ''
-        try:
-            # DICOM time format is HHMMSS.FFFFFF
-            if len(time_str) >= 6:
-                hour = time_str[0:2]
-                minute = time_str[2:4]
-                second = time_str[4:6]
-                return f"{hour}:{minute}:{second}"
-            return time_str
-        except:
-            return time_str
-    
-    def anonymize_name(self, name: str, patient_id: str) -> str:
-        """Anonymize patient name using patient ID"""
-        if not name or name == '':
-            return f"Patient_{patient_id}" if patient_id else "UNKNOWN"
-        return f"Patient_{patient_id}"
+        self.workers = workers or os.cpu_count()
+        self.use_threads = use_threads
+        self.readahead = readahead
+        
+        # Summary aggregates, updated as rows are written
+        self.total_files = 0
+        self.patients = set()
+        self.studies = set()
+        self.series = set()
+        self.modalities = {}  # dict as an insertion-ordered set
+        self.body_parts = Counter()
+        self.min_date = ''
+        self.max_date = ''
+        self.samples = []
     
-    def extract_info(self, dcm_file: Path) -> Dict:
+    def scan_directory(self, output_file: str, minimal: bool = False) -> int:
         """
-        Extract patient, date, and body part information from DICOM file
+        Scan directory and write information from all DICOM files to CSV
+        
+        Rows are written as they are extracted; only summary aggregates are
+        kept in memory.
         
         Returns:
-            Dict with extracted information
+            Number of files processed
         """
-        try:
-            ds = pydicom.dcmread(dcm_file, stop_before_pixels=True)
-            
-            # Extract patient information
-            patient_name = str(getattr(ds, 'PatientName', '')).strip()
-            patient_id = str(getattr(ds, 'PatientID', 'UNKNOWN')).strip()
-            patient_birth_date = str(getattr(ds, 'PatientBirthDate', '')).strip()
-            patient_sex = str(getattr(ds, 'PatientSex', '')).strip()
-            
-            # Anonymize if requested
-            if self.anonymize and patient_name:
-                display_name = self.anonymize_name(patient_name, patient_id)
-            else:
-                display_name = patient_name if patient_name else patient_id
-            
-            # Extract dates (try multiple date fields)
-            study_date = str(getattr(ds, 'StudyDate', '')).strip()
-            series_date = str(getattr(ds, 'SeriesDate', '')).strip()
-            acquisition_date = str(getattr(ds, 'AcquisitionDate', '')).strip()
-            content_date = str(getattr(ds, 'ContentDate', '')).strip()
-            
-            # Use the first available date
-            observation_date = study_date or series_date or acquisition_date or content_date
-            
-            # Extract times
-            study_time = str(getattr(ds, 'StudyTime', '')).strip()
-            series_time = str(getattr(ds, 'SeriesTime', '')).strip()
-            acquisition_time = str(getattr(ds, 'AcquisitionTime', '')).strip()
-            
-            observation_time = study_time or series_time or acquisition_time
-            
-            # Extract body part and descriptions
-            body_part = str(getattr(ds, 'BodyPartExamined', '')).strip()
-            study_desc = str(getattr(ds, 'StudyDescription', '')).strip()
-            series_desc = str(getattr(ds, 'SeriesDescription', '')).strip()
-            
-            # Combine descriptions for examined area
-            examined_area = body_part
-            if study_desc and study_desc not in examined_area:
-                examined_area = f"{body_part} - {study_desc}" if body_part else study_desc
-            if series_desc and series_desc not in examined_area:
-                examined_area = f"{examined_area} - {series_desc}" if examined_area else series_desc
-            
-            # Extract additional metadata
-            modality = str(getattr(ds, 'Modality', '')).strip()
-            institution = str(getattr(ds, 'InstitutionName', '')).strip()
-            study_uid = str(getattr(ds, 'StudyInstanceUID', '')).strip()
-            series_uid = str(getattr(ds, 'SeriesInstanceUID', '')).strip()
-            series_number = str(getattr(ds, 'SeriesNumber', '')).strip()
-            instance_number = str(getattr(ds, 'InstanceNumber', '')).strip()
-            
-            return {
-                'file_path': str(dcm_file),
-                'patient_name': display_name,
-                'patient_id': patient_id,
-                'patient_sex': patient_sex,
-                'patient_birth_date': self.format_date(patient_birth_date),
-                'observation_date': self.format_date(observation_date),
-                'observation_time': self.format_time(observation_time),
-                'observation_date_raw': observation_date,
-                'examined_area': examined_area,
-                'body_part': body_part,
-                'study_description': study_desc,
-                'series_description': series_desc,
-                'modality': modality,
-                'institution': institution,
-                'study_uid': study_uid,
-                'series_uid': series_uid,
-                'series_number': series_number,
-                'instance_number': instance_number,
-            }
-            
-        except Exception as e:
-            logger.warning(f"Error reading {dcm_file}: {e}")
-            return {
-                'file_path': str(dcm_file),
-                'patient_name': 'ERROR',
-                'patient_id': 'ERROR',
-                'patient_sex': '',
-                'patient_birth_date': '',
-                'observation_date': '',
-                'observation_time': '',
-                'observation_date_raw': '',
-                'examined_area': f'ERROR: {str(e)}',
-                'body_part': '',
-                'study_description': '',
-                'series_description': '',
-                'modality': '',
-                'institution': '',
-                'study_uid': '',
-                'series_uid': '',
-                'series_number': '',
-                'instance_number': '',
-            }
-    
-    def scan_directory(self) -> List[Dict]:
-        """Scan directory and extract information from all DICOM files"""
         logger.info(f"Scanning directory: {self.input_dir}")
         
         # Find all DICOM files
-        dcm_files = list(self.input_dir.rglob('*.dcm'))
+        dcm_files = [entry.path for entry in scandir_dcm(str(self.input_dir))]
         logger.info(f"Found {len(dcm_files)} DICOM files")
         
         if not dcm_files:
             logger.warning("No DICOM files found!")
-            return []
+            return 0
+        
+        # Process files in parallel; threads are better on network filesystems
+        # where reads dominate, processes when header parsing is CPU-bound
+        executor_cls = ThreadPoolExecutor if self.use_threads else ProcessPoolExecutor
+        extract = partial(
+            map_chunk, partial(extract_info, anonymize=self.anonymize), readahead=self.readahead
+        )
+        chunks = [dcm_files[i:i + CHUNK_SIZE] for i in range(0, len(dcm_files), CHUNK_SIZE)]
         
-        # Process each file
-        results = []
-        for idx, dcm_file in enumerate(dcm_files, 1):
-            if idx % 100 == 0:
-                logger.info(f"Processed {idx}/{len(dcm_files)} files...")
+        # Select columns based on mode
+        columns = MINIMAL_FIELDS if minimal else REPORT_FIELDS
+        schema = pa.schema([
+            (name, pa.dictionary(pa.int32(), pa.string())
+             if name in DICTIONARY_FIELDS else pa.string())
+            for name in columns
+        ])
+        indices = [REPORT_FIELDS.index(name) for name in columns]
+        
+        with pacsv.CSVWriter(output_file, schema) as writer, \
+                executor_cls(max_workers=self.workers) as executor:
+            batch = []
+            results = chain.from_iterable(executor.map(extract, chunks))
+            for idx, info in enumerate(results, 1):
+                if idx % 100 == 0:
+                    logger.info(f"Processed {idx}/{len(dcm_files)} files...")
+                
+                batch.append(info)
+                self._update_summary(info)
+                if len(batch) >= BATCH_SIZE:
+                    self._write_batch(writer, schema, indices, batch)
+                    batch = []
             
-            info = self.extract_info(dcm_file)
-            results.append(info)
+            if batch:
+                self._write_batch(writer, schema, indices, batch)
         
-        logger.info(f"Extracted information from {len(results)} files")
-        self.results = results
-        return results
+        logger.info(f"Extracted information from {self.total_files} files")
+        logger.info(f"Report saved to: {output_file}")
+        return self.total_files
     
-    def save_report(self, output_file: str, minimal: bool = False):
-        """Save results to CSV file"""
-        if not self.results:
-            logger.warning("No results to save")
-            return
+    @staticmethod
+    def _write_batch(writer, schema, indices: list, rows: list):
+        """Write buffered rows to the CSV report as one Arrow record batch"""
+        columns = list(zip(*rows))
+        arrays = []
+        for field, i in zip(schema, indices):
+            array = pa.array(columns[i], type=pa.string())
+            if field.name in _COLUMN_FORMATTERS:
+                array = _COLUMN_FORMATTERS[field.name](array)
+            if pa.types.is_dictionary(field.type):
+                array = array.dictionary_encode()
+            arrays.append(array)
+        writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=schema))
+    
+    def _update_summary(self, info: ReportRow):
+        """Fold one extracted row into the summary aggregates"""
+        self.total_files += 1
+        self.patients.add(info.patient_id)
+        self.studies.add(info.study_uid)
+        self.series.add(info.series_uid)
+        self.modalities[info.modality] = None
         
-        df = pd.DataFrame(self.results)
+        date = info.observation_date_raw
+        if date:
+            if not self.min_date or date < self.min_date:
+                self.min_date = date
+            if date > self.max_date:
+                self.max_date = date
         
-        # Select columns based on mode
-        if minimal:
-            columns = ['patient_name', 'observation_date', 'examined_area', 'file_path']
-            df_output = df[columns]
-        else:
-            df_output = df
+        if info.body_part:
+            self.body_parts[info.body_part] += 1
         
-        df_output.to_csv(output_file, index=False)
-        logger.info(f"Report saved to: {output_file}")
+        if len(self.samples) < 5:
+            self.samples.append(info)
+    
+    def print_summary(self):
+        """Print a summary of the scanned files"""
+        if not self.total_files:
+            logger.warning("No results to summarize")
+            return
         
-        # Print summary
         print("\n" + "="*80)
         print("SUMMARY")
         print("="*80)
-        print(f"Total DICOM files: {len(self.results)}")
-        print(f"Unique patients: {df['patient_id'].nunique()}")
-        print(f"Unique studies: {df['study_uid'].nunique()}")
-        print(f"Unique series: {df['series_uid'].nunique()}")
-        print(f"Modalities: {', '.join(df['modality'].unique())}")
+        print(f"Total DICOM files: {self.total_files}")
+        print(f"Unique patients: {len(self.patients)}")
+        print(f"Unique studies: {len(self.studies)}")
+        print(f"Unique series: {len(self.series)}")
+        print(f"Modalities: {', '.join(self.modalities)}")
         
         # Date range
-        valid_dates = df[df['observation_date_raw'] != '']['observation_date_raw']
-        if len(valid_dates) > 0:
-            min_date = valid_dates.min()
-            max_date = valid_dates.max()
-            print(f"\nDate range: {self.format_date(min_date)} to {self.format_date(max_date)}")
+        if self.min_date:
+            first, last = _format_dates(pa.array([self.min_date, self.max_date])).to_pylist()
+            print(f"\nDate range: {first} to {last}")
         
         # Body parts summary
         print(f"\nBody parts examined:")
-        body_parts = df[df['body_part'] != '']['body_part'].value_counts()
-        for part, count in body_parts.head(10).items():
+        for part, count in self.body_parts.most_common(10):
             print(f"  - {part}: {count} files")
         
         print(f"\nSample records:")
         print("-" * 80)
-        for _, row in df.head(5).iterrows():
-            print(f"Patient: {row['patient_name']}")
-            print(f"  Date: {row['observation_date']} {row['observation_time']}")
-            print(f"  Area: {row['examined_area']}")
-            print(f"  File: {Path(row['file_path']).name}")
+        dates = _format_dates(pa.array([row.observation_date for row in self.samples]))
+        times = _format_times(pa.array([row.observation_time for row in self.samples]))
+        for row, date, time in zip(self.samples, dates.to_pylist(), times.to_pylist()):
+            print(f"Patient: {row.patient_name}")
+            print(f"  Date: {date} {time}")
+            print(f"  Area: {row.examined_area}")
+            print(f"  File: {Path(row.file_path).name}")
             print()
 
 
@@ -293,6 +429,22 @@ Examples:
         action='store_true',
         help='Anonymize patient names (replace with Patient_ID)'
     )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        help='Number of parallel workers (default: number of CPUs)'
+    )
+    parser.add_argument(
+        '--threads',
+        action='store_true',
+        help='Use threads instead of processes (faster on network filesystems)'
+    )
+    parser.add_argument(
+        '--readahead',
+        type=int,
+        default=32,
+        help='Number of upcoming files to prefetch per worker, 0 to disable (default: 32)'
+    )
     parser.add_argument(
         '--debug',
         action='store_true',
@@ -305,14 +457,19 @@ Examples:
         logging.getLogger().setLevel(logging.DEBUG)
     
     # Create lister
-    lister = DicomInfoLister(args.input, anonymize=args.anonymize)
+    lister = DicomInfoLister(
+        args.input,
+        anonymize=args.anonymize,
+        workers=args.workers,
+        use_threads=args.threads,
+        readahead=args.readahead
+    )
     
-    # Scan directory
-    lister.scan_directory()
+    # Scan directory, writing the report as files are processed
+    lister.scan_directory(args.output, minimal=args.minimal)
     
-    # Save report
-    if lister.results:
-        lister.save_report(args.output, minimal=args.minimal)
+    if lister.total_files:
+        lister.print_summary()
     else:
         logger.error("No DICOM files processed!")
 
@@ -7,9 +7,16 @@ Supports limiting the number of images retrieved or downloading everything.
 """
 
 import argparse
+import hashlib
 import logging
 import os
+import sqlite3
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from io import BytesIO
 from pathlib import Path
 from typing import Optional
 from dotenv import load_dotenv
@@ -18,14 +25,38 @@ from dotenv import load_dotenv
 load_dotenv()
 
 try:
-    from pynetdicom import AE, evt, debug_logger
+    from pynetdicom import AE, build_role, evt, debug_logger
+    from pynetdicom.pdu_primitives import SOPClassExtendedNegotiation
+    from pynetdicom.presentation import build_context
     from pynetdicom.sop_class import (
         PatientRootQueryRetrieveInformationModelFind,
+        PatientRootQueryRetrieveInformationModelGet,
         PatientRootQueryRetrieveInformationModelMove,
         StudyRootQueryRetrieveInformationModelFind,
+        StudyRootQueryRetrieveInformationModelGet,
         StudyRootQueryRetrieveInformationModelMove,
+        NuclearMedicineImageStorage,
+        CTImageStorage,
+        MRImageStorage,
+        UltrasoundImageStorage,
+        SecondaryCaptureImageStorage,
+        ComputedRadiographyImageStorage,
+        DigitalXRayImageStorageForPresentation,
+        DigitalXRayImageStorageForProcessing,
     )
     from pydicom.dataset import Dataset
+    from pydicom.filereader import read_partial
+    from pydicom.pixels import get_encoder
+    from pydicom.tag import Tag
+    from pydicom.uid import (
+        ImplicitVRLittleEndian,
+        ExplicitVRLittleEndian,
+        ExplicitVRBigEndian,
+        JPEGBaseline8Bit,
+        JPEG2000Lossless,
+        RLELossless,
+    )
+    from dicom_scan import tag_value
 except ImportError:
     print("Error: pynetdicom and pydicom are required. Install with:")
     print("  pip install pynetdicom pydicom")
@@ -38,6 +69,187 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Storage contexts for NM and ALL common DICOM SOP classes
+# This PACS might have NM data in different SOP classes
+_STORAGE_CLASSES = [
+    NuclearMedicineImageStorage,
+    CTImageStorage,
+    MRImageStorage,
+    UltrasoundImageStorage,
+    SecondaryCaptureImageStorage,
+    ComputedRadiographyImageStorage,
+    DigitalXRayImageStorageForPresentation,
+    DigitalXRayImageStorageForProcessing,
+]
+_TRANSFER_SYNTAXES = [
+    ImplicitVRLittleEndian,
+    ExplicitVRLittleEndian,
+    ExplicitVRBigEndian,
+    JPEGBaseline8Bit,
+    JPEG2000Lossless,
+]
+
+# Built once at import. Requested contexts (SCU) keep one transfer syntax
+# each, so the PACS can accept every syntax it stores a class in (40
+# contexts, within the limit of 128); supported contexts (SCP) group them
+# per SOP class, the requestor's context picking the syntax
+_REQUESTED_STORAGE_CONTEXTS = [
+    build_context(sop_class, ts) for sop_class in _STORAGE_CLASSES for ts in _TRANSFER_SYNTAXES
+]
+_SUPPORTED_STORAGE_CONTEXTS = [
+    build_context(sop_class, _TRANSFER_SYNTAXES) for sop_class in _STORAGE_CLASSES
+]
+# C-GET sends images back over the requesting association, with us acting
+# as storage SCP for these classes
+_STORAGE_SCP_ROLES = [build_role(sop_class, scp_role=True) for sop_class in _STORAGE_CLASSES]
+_QUERY_RETRIEVE_CONTEXTS = {
+    # (use_study_root, use_c_get): [find context, retrieve context]
+    (True, True): [build_context(StudyRootQueryRetrieveInformationModelFind),
+                   build_context(StudyRootQueryRetrieveInformationModelGet)],
+    (True, False): [build_context(StudyRootQueryRetrieveInformationModelFind),
+                    build_context(StudyRootQueryRetrieveInformationModelMove)],
+    (False, True): [build_context(PatientRootQueryRetrieveInformationModelFind),
+                    build_context(PatientRootQueryRetrieveInformationModelGet)],
+    (False, False): [build_context(PatientRootQueryRetrieveInformationModelFind),
+                     build_context(PatientRootQueryRetrieveInformationModelMove)],
+}
+
+
+# Identifiers for C-FIND and retrieve requests, built afresh for each
+# request so that no elements are shared between requests or threads
+def _study_query(study_date: str) -> Dataset:
+    """Return a STUDY level C-FIND identifier for NM studies on study_date"""
+    ds = Dataset()
+    ds.QueryRetrieveLevel = 'STUDY'
+    ds.StudyDate = study_date
+    ds.StudyInstanceUID = ''
+    ds.PatientID = ''
+    ds.ModalitiesInStudy = 'NM'  # Most PACS filter on this server-side
+    ds.NumberOfStudyRelatedInstances = ''
+    return ds
+
+
+def _series_query(study_uid: str = '', study_date: Optional[str] = None) -> Dataset:
+    """Return a SERIES level C-FIND identifier for NM series"""
+    ds = Dataset()
+    ds.QueryRetrieveLevel = 'SERIES'
+    if study_date is not None:
+        ds.StudyDate = study_date
+    ds.Modality = 'NM'
+    ds.StudyInstanceUID = study_uid
+    ds.SeriesInstanceUID = ''
+    ds.SeriesDescription = ''
+    ds.SeriesNumber = ''
+    ds.NumberOfSeriesRelatedInstances = ''
+    return ds
+
+
+def _series_retrieve(study_uid: str, series_uid: str) -> Dataset:
+    """Return a SERIES level C-GET/C-MOVE identifier"""
+    ds = Dataset()
+    ds.QueryRetrieveLevel = 'SERIES'
+    ds.StudyInstanceUID = study_uid
+    ds.SeriesInstanceUID = series_uid
+    return ds
+
+
+# Lossless transfer syntaxes images can be compressed to when stored
+# (--compress-on-store); JPEG 2000 needs pylibjpeg-openjpeg
+_STORE_COMPRESSION = {
+    'none': None,
+    'rle': RLELossless,
+    'j2k': JPEG2000Lossless,
+}
+
+# Index of stored images in the output directory, used to skip studies and
+# series already retrieved by a previous run
+_INDEX_FILENAME = '.index.sqlite3'
+_INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    sop_uid TEXT PRIMARY KEY,  -- also the index on sop_uid
+    study_uid TEXT NOT NULL,
+    series_uid TEXT NOT NULL,
+    sha1 TEXT NOT NULL,
+    bytes INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS images_study_uid ON images (study_uid);
+CREATE INDEX IF NOT EXISTS images_series_uid ON images (series_uid);
+"""
+
+# Stored images are logged at INFO level once every this many images
+_LOG_EVERY = 50
+
+# Tags needed to file incoming images, in file order
+_TAG_PATIENT_ID = Tag(0x0010, 0x0020)
+_TAG_STUDY_INSTANCE_UID = Tag(0x0020, 0x000D)
+_TAG_SERIES_INSTANCE_UID = Tag(0x0020, 0x000E)
+_STORE_TAGS = [_TAG_PATIENT_ID, _TAG_STUDY_INSTANCE_UID, _TAG_SERIES_INSTANCE_UID]
+
+
+def _raw_tag_value(ds: Dataset, tag, default: str = '') -> str:
+    """
+    Return a text tag's value decoded straight from its raw bytes
+    
+    Skips pydicom's conversion of the raw element; values that are not
+    plain ASCII go through it as usual.
+    """
+    elem = ds.get_item(tag)
+    if elem is None:
+        return default
+    value = elem.value
+    if isinstance(value, bytes):
+        try:
+            return value.decode('ascii').strip(' \x00')
+        except UnicodeDecodeError:
+            pass
+    return tag_value(ds, tag, default)
+
+
+class _SafeCharTable(dict):
+    """
+    str.translate table keeping only alphanumerics, '-' and '_'
+    
+    ASCII is filled in upfront; other code points are classified on first
+    use and cached.
+    """
+    
+    def __init__(self):
+        super().__init__((codepoint, self._keep(codepoint)) for codepoint in range(128))
+    
+    @staticmethod
+    def _keep(codepoint: int) -> Optional[int]:
+        char = chr(codepoint)
+        return codepoint if char.isalnum() or char in '-_' else None
+    
+    def __missing__(self, codepoint: int) -> Optional[int]:
+        self[codepoint] = keep = self._keep(codepoint)
+        return keep
+
+
+_SAFE_CHARS = _SafeCharTable()
+
+
+@contextmanager
+def _high_resolution_timer():
+    """
+    Set the Windows timer resolution to 1 ms for the duration of the block
+    
+    pynetdicom's DUL and reactor loops sleep between PDUs, and with the
+    default ~15.6 ms Windows timer granularity each sleep caps throughput.
+    No-op on other platforms.
+    """
+    if sys.platform != 'win32':
+        yield
+        return
+    
+    import ctypes
+    winmm = ctypes.WinDLL('winmm')
+    winmm.timeBeginPeriod(1)
+    try:
+        yield
+    finally:
+        winmm.timeEndPeriod(1)
+
 
 class PACSNMRetriever:
     """Retrieve Nuclear Medicine DICOM images from PACS"""
@@ -52,7 +264,11 @@ class PACSNMRetriever:
         output_dir: str = "./nm_images",
         use_study_root: bool = True,
         dry_run: bool = False,
-        use_c_get: bool = True  # Default to C-GET (simpler)
+        use_c_get: bool = True,  # Default to C-GET (simpler)
+        max_parallel: int = 1,
+        use_dcmtk: bool = False,
+        compress_on_store: str = 'none',
+        drop_page_cache: bool = False
     ):
         self.pacs_host = pacs_host
         self.pacs_port = pacs_port
@@ -61,6 +277,16 @@ class PACSNMRetriever:
         self.local_port = local_port
         self.output_dir = Path(output_dir).resolve()
         
+        # Check the encoder upfront rather than failing on every image
+        self._store_compression = _STORE_COMPRESSION[compress_on_store]
+        if self._store_compression is not None:
+            encoder = get_encoder(self._store_compression)
+            if not encoder.is_available:
+                raise ValueError(
+                    f"--compress-on-store {compress_on_store} is unavailable, missing: "
+                    f"{'; '.join(encoder.missing_dependencies)}"
+                )
+        
         try:
             self.output_dir.mkdir(parents=True, exist_ok=True)
             logger.info(f"Output directory: {self.output_dir}")
@@ -74,6 +300,13 @@ class PACSNMRetriever:
         self.use_study_root = use_study_root
         self.dry_run = dry_run
         self.use_c_get = use_c_get
+        self.use_dcmtk = use_dcmtk
+        self.drop_page_cache = drop_page_cache and hasattr(os, 'posix_fadvise')
+        self.max_parallel = max_parallel
+        
+        # Study date range used when none is given: the last 30 days
+        end_date = datetime.now()
+        self._default_study_date = f"{end_date - timedelta(days=30):%Y%m%d}-{end_date:%Y%m%d}"
         
         # Initialize Application Entity
         self.ae = AE(ae_title=local_aet)
@@ -83,106 +316,235 @@ class PACSNMRetriever:
         self.ae.acse_timeout = 30
         self.ae.dimse_timeout = 30
         
-        # Add presentation contexts for query/retrieve
-        if use_study_root:
-            self.ae.add_requested_context(StudyRootQueryRetrieveInformationModelFind)
-            if use_c_get:
-                from pynetdicom.sop_class import StudyRootQueryRetrieveInformationModelGet
-                self.ae.add_requested_context(StudyRootQueryRetrieveInformationModelGet)
-            else:
-                self.ae.add_requested_context(StudyRootQueryRetrieveInformationModelMove)
-        else:
-            self.ae.add_requested_context(PatientRootQueryRetrieveInformationModelFind)
-            if use_c_get:
-                from pynetdicom.sop_class import PatientRootQueryRetrieveInformationModelGet
-                self.ae.add_requested_context(PatientRootQueryRetrieveInformationModelGet)
-            else:
-                self.ae.add_requested_context(PatientRootQueryRetrieveInformationModelMove)
-        
-        # Add storage contexts for NM and ALL common DICOM SOP classes
-        # This PACS might have NM data in different SOP classes
-        from pynetdicom.sop_class import (
-            NuclearMedicineImageStorage,
-            CTImageStorage,
-            MRImageStorage,
-            UltrasoundImageStorage,
-            SecondaryCaptureImageStorage,
-            ComputedRadiographyImageStorage,
-            DigitalXRayImageStorageForPresentation,
-            DigitalXRayImageStorageForProcessing,
-        )
-        from pydicom.uid import (
-            ImplicitVRLittleEndian,
-            ExplicitVRLittleEndian,
-            ExplicitVRBigEndian,
-            JPEGBaseline8Bit,
-            JPEG2000Lossless,
+        # No limit on the size of PDUs sent to our storage SCP (C-MOVE), so
+        # large NM objects are not split into thousands of 16 KB PDUs
+        self.ae.maximum_pdu_size = 0
+        
+        # Add presentation contexts for query/retrieve and storage, as both
+        # requested (for SCU) and supported (for SCP)
+        self.ae.requested_contexts = (
+            _QUERY_RETRIEVE_CONTEXTS[(use_study_root, use_c_get)] + _REQUESTED_STORAGE_CONTEXTS
         )
+        self.ae.supported_contexts = _SUPPORTED_STORAGE_CONTEXTS
         
-        transfer_syntaxes = [
-            ImplicitVRLittleEndian,
-            ExplicitVRLittleEndian,
-            ExplicitVRBigEndian,
-            JPEGBaseline8Bit,
-            JPEG2000Lossless,
-        ]
+        self.image_count = 0
+        self._count_lock = threading.Lock()
         
-        # Add all common storage SOP classes
-        storage_classes = [
-            NuclearMedicineImageStorage,
-            CTImageStorage,
-            MRImageStorage,
-            UltrasoundImageStorage,
-            SecondaryCaptureImageStorage,
-            ComputedRadiographyImageStorage,
-            DigitalXRayImageStorageForPresentation,
-            DigitalXRayImageStorageForProcessing,
-        ]
+        # Storage SCP for C-MOVE, started on first use
+        self._scp = None
+        self._scp_lock = threading.Lock()
         
-        # Add as both requested (for SCU) and supported (for SCP)
-        for sop_class in storage_classes:
-            for ts in transfer_syntaxes:
-                self.ae.add_requested_context(sop_class, ts)
-                self.ae.add_supported_context(sop_class, ts)
+        # Series directories already created by handle_store
+        self._created_dirs: set[Path] = set()
         
-        self.image_count = 0
+        # Index of stored images, shared by the threads storing images and
+        # committed once per study (not used in dry-run mode)
+        self._index = None
+        self._index_lock = threading.Lock()
+        if not dry_run:
+            self._index = sqlite3.connect(self.output_dir / _INDEX_FILENAME,
+                                          check_same_thread=False)
+            self._index.executescript(_INDEX_SCHEMA)
+        
+        # One association per thread, shared by all of its C-FIND/C-MOVE
+        # requests; all of them are kept to be released at the end of the run
+        self._local = threading.local()
+        self._assocs = []
+        self._assocs_lock = threading.Lock()
+        
+    def _ensure_assoc(self):
+        """Return this thread's association with the PACS, (re)opening it if needed"""
+        assoc = getattr(self._local, 'assoc', None)
+        if assoc is not None and assoc.is_established:
+            return assoc
+        
+        query_model = (StudyRootQueryRetrieveInformationModelFind if self.use_study_root
+                      else PatientRootQueryRetrieveInformationModelFind)
+        
+        # Ask for relational queries, so series can be searched without
+        # going through each study first
+        relational = SOPClassExtendedNegotiation()
+        relational.sop_class_uid = query_model
+        relational.service_class_application_information = b'\x01'
+        ext_neg = [relational]
+        if self.use_c_get and not self.use_dcmtk:
+            ext_neg += _STORAGE_SCP_ROLES
+        
+        # max_pdu=0: no limit on the size of PDUs sent to us by the PACS
+        assoc = self.ae.associate(
+            self.pacs_host, self.pacs_port, ae_title=self.pacs_aet,
+            max_pdu=0, ext_neg=ext_neg,
+            evt_handlers=[(evt.EVT_C_STORE, self.handle_store)]
+        )
+        if not assoc.is_established:
+            self._local.assoc = None
+            return None
         
+        self._local.assoc = assoc
+        with self._assocs_lock:
+            self._assocs.append(assoc)
+        return assoc
+    
+    def _supports_relational_queries(self, assoc) -> bool:
+        """Check if the PACS accepted relational queries on the association"""
+        query_model = (StudyRootQueryRetrieveInformationModelFind if self.use_study_root
+                      else PatientRootQueryRetrieveInformationModelFind)
+        app_info = assoc.acceptor.sop_class_extended.get(query_model)
+        return bool(app_info) and bool(app_info[0] & 0x01)
+    
+    def _release_assoc(self):
+        """Release this thread's association, if it has one"""
+        assoc = getattr(self._local, 'assoc', None)
+        if assoc is None:
+            return
+        self._local.assoc = None
+        with self._assocs_lock:
+            self._assocs.remove(assoc)
+        if assoc.is_established:
+            assoc.release()
+    
+    def _close_assocs(self):
+        """Release all associations opened during the run"""
+        with self._assocs_lock:
+            assocs, self._assocs = self._assocs, []
+        for assoc in assocs:
+            if assoc.is_established:
+                assoc.release()
+        self._local = threading.local()
+    
+    def _add_images(self, count: int = 1) -> int:
+        """Add to the retrieved image count, returning the new total"""
+        with self._count_lock:
+            self.image_count += count
+            return self.image_count
+    
     def handle_store(self, event):
         """Handle C-STORE requests (incoming DICOM files)"""
-        ds = event.dataset
-        ds.file_meta = event.file_meta
+        # The dataset is written as received (preamble, file meta and encoded
+        # dataset); only the few tags needed to file it are parsed
+        data = event.encoded_dataset()
+        ds = read_partial(
+            BytesIO(data),
+            stop_when=lambda tag, vr, length: tag > _TAG_SERIES_INSTANCE_UID,
+            specific_tags=_STORE_TAGS
+        )
         
         # Create directory structure: PatientID/StudyInstanceUID/SeriesInstanceUID/
-        patient_id = getattr(ds, 'PatientID', 'UNKNOWN')
-        study_uid = getattr(ds, 'StudyInstanceUID', 'UNKNOWN')
-        series_uid = getattr(ds, 'SeriesInstanceUID', 'UNKNOWN')
-        sop_uid = getattr(ds, 'SOPInstanceUID', 'UNKNOWN')
+        patient_id = _raw_tag_value(ds, _TAG_PATIENT_ID, 'UNKNOWN')
+        study_uid = _raw_tag_value(ds, _TAG_STUDY_INSTANCE_UID, 'UNKNOWN')
+        series_uid = _raw_tag_value(ds, _TAG_SERIES_INSTANCE_UID, 'UNKNOWN')
+        sop_uid = event.request.AffectedSOPInstanceUID or 'UNKNOWN'
         
         # Sanitize directory names
-        patient_id = "".join(c for c in patient_id if c.isalnum() or c in ('-', '_'))
+        patient_id = patient_id.translate(_SAFE_CHARS)
         
-        self.image_count += 1
+        image_number = self._add_images()
         
         if self.dry_run:
-            logger.info(f"[DRY-RUN] Would store image {self.image_count}: {patient_id}/{study_uid}/{series_uid}/{sop_uid}.dcm")
+            logger.log(
+                logging.INFO if image_number % _LOG_EVERY == 0 else logging.DEBUG,
+                "[DRY-RUN] Would store image %d: %s/%s/%s/%s.dcm",
+                image_number, patient_id, study_uid, series_uid, sop_uid
+            )
             return 0x0000
         
         save_dir = self.output_dir / patient_id / study_uid / series_uid
-        save_dir.mkdir(parents=True, exist_ok=True)
+        if save_dir not in self._created_dirs:
+            save_dir.mkdir(parents=True, exist_ok=True)
+            self._created_dirs.add(save_dir)
         
         # Save file
         filename = f"{sop_uid}.dcm"
         filepath = save_dir / filename
         
+        if self._store_compression:
+            data = self._compress(event, data)
+        
         try:
-            ds.save_as(filepath, write_like_original=False)
-            logger.info(f"Stored image {self.image_count}: {filepath}")
+            with open(filepath, 'wb') as f:
+                f.write(data)
+                if self.drop_page_cache:
+                    # Keep written images out of the page cache, which large
+                    # retrievals would otherwise fill. Only clean pages are
+                    # dropped, so the image is synced to disk first
+                    f.flush()
+                    os.fdatasync(f.fileno())
+                    os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+            logger.log(
+                logging.INFO if image_number % _LOG_EVERY == 0 else logging.DEBUG,
+                "Stored image %d: %s", image_number, filepath
+            )
         except Exception as e:
-            logger.error(f"Failed to save image {self.image_count}: {e}")
+            logger.error(f"Failed to save image {image_number}: {e}")
             return 0xC000  # Failure
         
+        sha1 = hashlib.sha1(data).hexdigest()
+        with self._index_lock:
+            self._index.execute(
+                "INSERT OR IGNORE INTO images VALUES (?, ?, ?, ?, ?)",
+                (sop_uid, study_uid, series_uid, sha1, len(data))
+            )
+        
         return 0x0000  # Success
     
+    def _compress(self, event, data: bytes) -> bytes:
+        """
+        Losslessly compress a received image for storage
+        
+        Images already in a compressed transfer syntax, without pixel data,
+        or that cannot be compressed, are returned as received.
+        """
+        file_meta = event.file_meta
+        if file_meta.TransferSyntaxUID.is_compressed:
+            return data
+        
+        try:
+            ds = event.dataset
+            if 'PixelData' not in ds:
+                return data
+            ds.file_meta = file_meta
+            # Lossless: the pixels and so the SOP Instance UID are unchanged
+            ds.compress(self._store_compression, generate_instance_uid=False)
+            buffer = BytesIO()
+            ds.save_as(buffer, enforce_file_format=True)
+            return buffer.getvalue()
+        except Exception as e:
+            logger.warning(f"Could not compress {event.request.AffectedSOPInstanceUID}, "
+                           f"storing it as received: {e}")
+            return data
+    
+    def _is_indexed(self, level: str, uid: str, expected_instances) -> bool:
+        """Check if all expected instances of a study or series are in the index
+        
+        Args:
+            level: 'study' or 'series'
+            uid: StudyInstanceUID or SeriesInstanceUID
+            expected_instances: Number of related instances reported by the PACS
+        """
+        expected_instances = int(expected_instances or 0)
+        if self._index is None or expected_instances <= 0:
+            return False
+        
+        with self._index_lock:
+            (count,) = self._index.execute(
+                f"SELECT COUNT(*) FROM images WHERE {level}_uid = ?", (uid,)
+            ).fetchone()
+        return count >= expected_instances
+    
+    def _commit_index(self):
+        """Commit the images stored since the last commit to the index"""
+        if self._index is None:
+            return
+        with self._index_lock:
+            self._index.commit()
+    
+    def _resolve_study_date(self, study_date: str) -> str:
+        """Return study_date, or the default range of the last 30 days if empty"""
+        if study_date:
+            return study_date
+        logger.info(f"No date specified, using last 30 days: {self._default_study_date}")
+        return self._default_study_date
+    
     def find_nm_studies(self, limit: Optional[int] = None, study_date: str = '') -> list[Dataset]:
         """Find NM studies on PACS
         
@@ -192,44 +554,64 @@ class PACSNMRetriever:
         """
         logger.info(f"Searching for studies on {self.pacs_host}:{self.pacs_port}")
         
-        if not study_date:
-            # Default to last 30 days
-            from datetime import datetime, timedelta
-            end_date = datetime.now()
-            start_date = end_date - timedelta(days=30)
-            study_date = f"{start_date.strftime('%Y%m%d')}-{end_date.strftime('%Y%m%d')}"
-            logger.info(f"No date specified, using last 30 days: {study_date}")
+        study_date = self._resolve_study_date(study_date)
         
         # This PACS requires StudyDate filter
-        ds = Dataset()
-        ds.QueryRetrieveLevel = 'STUDY'
-        ds.StudyDate = study_date
-        ds.StudyInstanceUID = ''
-        ds.PatientID = ''
-        ds.ModalitiesInStudy = ''  # Request this field to filter by NM
+        ds = _study_query(study_date)
         
-        all_studies = []
+        nm_studies = []
+        total_studies = 0
         
         # Associate with PACS
         query_model = (StudyRootQueryRetrieveInformationModelFind if self.use_study_root
                       else PatientRootQueryRetrieveInformationModelFind)
         
         try:
-            assoc = self.ae.associate(self.pacs_host, self.pacs_port, ae_title=self.pacs_aet)
+            assoc = self._ensure_assoc()
             
-            if assoc.is_established:
+            if assoc:
                 logger.info(f"Sending C-FIND request for studies (date: {study_date})...")
-                responses = assoc.send_c_find(ds, query_model)
+                msg_id = 1
+                responses = assoc.send_c_find(ds, query_model, msg_id=msg_id)
                 
+                # Studies are still checked for NM as they arrive, for PACS
+                # that ignore the ModalitiesInStudy filter. Once the limit is
+                # reached the query is cancelled, and the remaining responses
+                # are drained so that the association can be reused
+                cancelled = False
                 for status, identifier in responses:
-                    if status and status.Status in (0xFF00, 0xFF01):  # Pending
-                        if identifier:
-                            all_studies.append(identifier)
-                            if len(all_studies) % 100 == 0:
-                                logger.info(f"Retrieved {len(all_studies)} studies so far...")
+                    if cancelled or not identifier or not (status and status.Status in (0xFF00, 0xFF01)):
+                        continue
+                    
+                    total_studies += 1
+                    if total_studies % 100 == 0:
+                        logger.info(f"Retrieved {total_studies} studies so far...")
+                    
+                    modalities = getattr(identifier, 'ModalitiesInStudy', None)
+                    if not modalities:
+                        continue
+                    
+                    # Convert to string for easier parsing
+                    modalities_str = str(modalities)
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug("Study modalities: %s (type: %s)", modalities_str, type(modalities).__name__)
+                    
+                    # Check if NM is in the modalities
+                    if 'NM' in modalities_str:
+                        nm_studies.append(identifier)
+                        logger.info(f"Found NM study: {identifier.StudyInstanceUID} - Modalities: {modalities_str}")
+                        
+                        if limit and len(nm_studies) >= limit:
+                            logger.info(f"Reached study limit of {limit}, cancelling C-FIND")
+                            assoc.send_c_cancel(msg_id, query_model=query_model)
+                            cancelled = True
                 
-                assoc.release()
-                logger.info(f"Retrieved {len(all_studies)} studies for date range {study_date}")
+                logger.info(f"Retrieved {total_studies} studies for date range {study_date}")
+                if len(nm_studies) < total_studies:
+                    logger.info(f"PACS ignored the ModalitiesInStudy filter, filtered "
+                                f"{total_studies - len(nm_studies)} studies without NM locally")
+                else:
+                    logger.info("PACS filtered studies on ModalitiesInStudy")
             else:
                 logger.error("Failed to associate with PACS")
                 return []
@@ -237,52 +619,21 @@ class PACSNMRetriever:
             logger.error(f"Error during C-FIND: {e}")
             return []
         
-        if not all_studies:
+        if not total_studies:
             logger.warning("No studies found for specified date range")
             return []
         
-        # Filter for studies containing NM modality
-        nm_studies = []
-        for study in all_studies:
-            modalities = getattr(study, 'ModalitiesInStudy', None)
-            if modalities:
-                # Convert to string for easier parsing
-                modalities_str = str(modalities)
-                logger.debug(f"Study modalities: {modalities_str} (type: {type(modalities).__name__})")
-                
-                # Check if NM is in the modalities
-                if 'NM' in modalities_str:
-                    nm_studies.append(study)
-                    logger.info(f"Found NM study: {study.StudyInstanceUID} - Modalities: {modalities_str}")
-                    
-                    if limit and len(nm_studies) >= limit:
-                        logger.info(f"Reached study limit of {limit}")
-                        break
-        
-        # Return studies up to limit
-        result_studies = nm_studies[:limit] if limit else nm_studies
-        logger.info(f"Returning {len(result_studies)} NM studies (out of {len(all_studies)} total)")
+        logger.info(f"Returning {len(nm_studies)} NM studies (out of {total_studies} total)")
         
-        if len(nm_studies) == 0:
+        if not nm_studies:
             logger.warning(f"No NM studies found in date range {study_date}")
-            logger.warning(f"Total studies in range: {len(all_studies)}")
+            logger.warning(f"Total studies in range: {total_studies}")
         
-        return result_studies
-    
-    def _study_has_nm_series(self, study_uid: str) -> bool:
-        """Check if a study has any NM series"""
-        return True
+        return nm_studies
     
     def find_nm_series(self, study_uid: str, limit: Optional[int] = None) -> list[Dataset]:
         """Find all NM series in a study"""
-        ds = Dataset()
-        ds.QueryRetrieveLevel = 'SERIES'
-        ds.StudyInstanceUID = study_uid
-        ds.Modality = 'NM'
-        ds.SeriesInstanceUID = ''
-        ds.SeriesDescription = ''
-        ds.SeriesNumber = ''
-        ds.NumberOfSeriesRelatedInstances = ''
+        ds = _series_query(study_uid)
         
         series = []
         
@@ -290,35 +641,97 @@ class PACSNMRetriever:
                       else PatientRootQueryRetrieveInformationModelFind)
         
         try:
-            assoc = self.ae.associate(self.pacs_host, self.pacs_port, ae_title=self.pacs_aet)
+            assoc = self._ensure_assoc()
             
-            if assoc.is_established:
-                responses = assoc.send_c_find(ds, query_model)
+            if assoc:
+                msg_id = 1
+                responses = assoc.send_c_find(ds, query_model, msg_id=msg_id)
                 
+                # Once the limit is reached the query is cancelled, and the
+                # remaining responses are drained so that the association can
+                # be reused
+                cancelled = False
                 for status, identifier in responses:
+                    if cancelled:
+                        continue
                     if status and status.Status in (0xFF00, 0xFF01):
                         if identifier:
                             series.append(identifier)
                             
                             if limit and len(series) >= limit:
-                                break
-                
-                assoc.release()
+                                assoc.send_c_cancel(msg_id, query_model=query_model)
+                                cancelled = True
         except Exception as e:
             logger.error(f"Error finding series: {e}")
             
         return series
     
-    def retrieve_study(self, study_uid: str) -> bool:
-        """Retrieve only NM series from study using C-GET or C-MOVE"""
+    def find_nm_series_by_date(self, study_date: str) -> Optional[dict[str, list[Dataset]]]:
+        """Find all NM series of a date range with a single relational C-FIND
+        
+        Returns:
+            Series grouped by StudyInstanceUID, or None if the PACS does not
+            support relational queries
+        """
+        assoc = self._ensure_assoc()
+        if not assoc or not self._supports_relational_queries(assoc):
+            logger.info("Relational queries not supported, querying series study by study")
+            return None
+        
+        ds = _series_query(study_date=study_date)
+        
+        query_model = (StudyRootQueryRetrieveInformationModelFind if self.use_study_root
+                      else PatientRootQueryRetrieveInformationModelFind)
+        
+        series_by_study = {}
+        try:
+            logger.info(f"Sending relational C-FIND request for NM series (date: {study_date})...")
+            for status, identifier in assoc.send_c_find(ds, query_model):
+                if not status:
+                    continue
+                if status.Status in (0xFF00, 0xFF01):
+                    if identifier:
+                        series_by_study.setdefault(identifier.get('StudyInstanceUID', ''), []).append(identifier)
+                elif status.Status != 0x0000:
+                    logger.warning(f"Relational C-FIND failed (status 0x{status.Status:04x}), "
+                                   "querying series study by study")
+                    return None
+        except Exception as e:
+            logger.error(f"Error during relational C-FIND: {e}")
+            return None
+        
+        logger.info(f"Found {sum(map(len, series_by_study.values()))} NM series "
+                    f"in {len(series_by_study)} studies")
+        return series_by_study
+    
+    def retrieve_study(
+        self,
+        study_uid: str,
+        nm_series: Optional[list[Dataset]] = None,
+        expected_instances: Optional[int] = None
+    ) -> bool:
+        """Retrieve only NM series from study using C-GET or C-MOVE
+        
+        Studies and series whose instances are all in the index are skipped.
+        
+        Args:
+            study_uid: StudyInstanceUID of the study
+            nm_series: NM series of the study if already known, queried otherwise
+            expected_instances: NumberOfStudyRelatedInstances of the study, if known
+        """
         logger.info(f"{'[DRY-RUN] ' if self.dry_run else ''}Retrieving NM series from study: {study_uid}")
         
         if self.dry_run:
             logger.info(f"[DRY-RUN] Would retrieve NM series from study {study_uid}")
             return True
         
+        if self._is_indexed('study', study_uid, expected_instances):
+            logger.info(f"Study {study_uid} already retrieved, skipping")
+            return True
+        
         # First, find NM series in this study
-        nm_series = self.find_nm_series(study_uid)
+        if nm_series is None:
+            nm_series = self.find_nm_series(study_uid)
         
         if not nm_series:
             logger.warning(f"No NM series found in study {study_uid}")
@@ -331,25 +744,78 @@ class PACSNMRetriever:
         for series in nm_series:
             series_uid = series.SeriesInstanceUID
             
+            # The study may hold other modalities, so only its NM series
+            # can be found complete
+            if self._is_indexed('series', series_uid,
+                                series.get('NumberOfSeriesRelatedInstances')):
+                logger.info(f"Series {series_uid} already retrieved, skipping")
+                continue
+            
             # Create retrieve dataset for SERIES level
-            ds = Dataset()
-            ds.QueryRetrieveLevel = 'SERIES'
-            ds.StudyInstanceUID = study_uid
-            ds.SeriesInstanceUID = series_uid
+            ds = _series_retrieve(study_uid, series_uid)
             
             if self.use_c_get:
-                if not self._retrieve_with_get(ds):
+                retrieve = self._retrieve_with_getscu if self.use_dcmtk else self._retrieve_with_get
+                if not retrieve(ds):
                     success = False
             else:
                 if not self._retrieve_with_move(ds):
                     success = False
         
+        # One index transaction per study
+        self._commit_index()
+        
         return success
     
     def _retrieve_with_get(self, ds: Dataset) -> bool:
-        """Retrieve using C-GET via DCMTK getscu (more reliable)"""
+        """Retrieve using C-GET, images coming back to handle_store over the same association"""
+        get_model = (StudyRootQueryRetrieveInformationModelGet if self.use_study_root
+                     else PatientRootQueryRetrieveInformationModelGet)
+        
+        if ds.QueryRetrieveLevel == 'SERIES':
+            logger.info(f"Retrieving NM series {ds.SeriesInstanceUID}...")
+        else:
+            logger.info(f"Retrieving study {ds.StudyInstanceUID}...")
+        
+        try:
+            assoc = self._ensure_assoc()
+            if not assoc:
+                logger.error("Failed to associate for C-GET")
+                return False
+            
+            final_status = None
+            for status, identifier in assoc.send_c_get(ds, get_model):
+                if not status:
+                    continue
+                final_status = status
+                if status.Status == 0xFF00:
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug("C-GET pending: %s remaining", status.get('NumberOfRemainingSuboperations'))
+        except Exception as e:
+            logger.error(f"Error during C-GET: {e}")
+            return False
+        
+        if final_status is None:
+            logger.error("C-GET failed: no response from PACS (timeout or aborted association)")
+            return False
+        
+        completed = final_status.get('NumberOfCompletedSuboperations') or 0
+        failed = final_status.get('NumberOfFailedSuboperations') or 0
+        if final_status.Status == 0x0000:
+            logger.info(f"Retrieved {completed} images")
+            return True
+        if final_status.Status == 0xB000:
+            logger.warning(f"C-GET completed with warnings: {completed} images retrieved, {failed} failed")
+            return True
+        
+        logger.error(f"C-GET failed with status 0x{final_status.Status:04x}")
+        return False
+    
+    def _retrieve_with_getscu(self, ds: Dataset) -> bool:
+        """Retrieve using C-GET via DCMTK getscu (fallback)"""
         import subprocess
         import shutil
+        import tempfile
         
         # Check if getscu is available
         if not shutil.which('getscu'):
@@ -382,7 +848,10 @@ class PACSNMRetriever:
         else:
             logger.info(f"Retrieving study {study_uid}...")
         
-        cmd.extend(['-od', str(self.output_dir)])
+        # getscu writes into a directory of its own, so that only the files
+        # of this retrieval are renamed afterwards
+        download_dir = Path(tempfile.mkdtemp(prefix='.getscu-', dir=self.output_dir))
+        cmd.extend(['-od', str(download_dir)])
         
         logger.info(f"Running getscu command: {' '.join(cmd)}")
         
@@ -413,28 +882,8 @@ class PACSNMRetriever:
                         except:
                             pass
                 
-                # Count files actually in output directory
-                total_files = sum(1 for root, dirs, files in os.walk(self.output_dir) for f in files)
-                logger.info(f"Files found in {self.output_dir}: {total_files}")
-                
-                # Rename files without .dcm extension
-                renamed_count = 0
-                for root, dirs, files in os.walk(self.output_dir):
-                    for filename in files:
-                        if not filename.endswith('.dcm'):
-                            old_path = Path(root) / filename
-                            new_path = Path(root) / f"{filename}.dcm"
-                            try:
-                                old_path.rename(new_path)
-                                renamed_count += 1
-                            except Exception as e:
-                                logger.warning(f"Failed to rename {old_path}: {e}")
-                
-                if renamed_count > 0:
-                    logger.info(f"Renamed {renamed_count} files to add .dcm extension")
-                
                 if completed > 0:
-                    self.image_count += completed
+                    self._add_images(completed)
                     logger.info(f"Retrieved {completed} images")
                 else:
                     logger.info(f"getscu completed (check {self.output_dir} for files)")
@@ -452,52 +901,71 @@ class PACSNMRetriever:
         except Exception as e:
             logger.error(f"Error running getscu: {e}")
             return False
+        finally:
+            self._move_downloads(download_dir)
     
-    def _retrieve_with_move(self, ds: Dataset) -> bool:
-        """Retrieve using C-MOVE (requires storage SCP)"""
-    def _retrieve_with_move(self, ds: Dataset) -> bool:
-        """Retrieve using C-MOVE (requires storage SCP)"""
-        # Setup storage SCP handlers
-        handlers = [(evt.EVT_C_STORE, self.handle_store)]
+    def _move_downloads(self, download_dir: Path):
+        """Move files received by getscu into the output directory, adding the .dcm extension"""
+        moved_count = 0
+        with os.scandir(download_dir) as it:
+            for entry in it:
+                filename = entry.name if entry.name.endswith('.dcm') else f"{entry.name}.dcm"
+                try:
+                    os.replace(entry.path, self.output_dir / filename)
+                    moved_count += 1
+                except OSError as e:
+                    logger.warning(f"Failed to move {entry.path}: {e}")
         
-        # Start storage SCP in background
         try:
-            logger.info(f"Starting storage SCP on port {self.local_port}...")
-            scp = self.ae.start_server(
-                ('0.0.0.0', self.local_port),  # Listen on all interfaces
-                block=False,
-                evt_handlers=handlers
-            )
+            download_dir.rmdir()
+        except OSError as e:
+            logger.warning(f"Failed to remove {download_dir}: {e}")
+        
+        logger.info(f"Moved {moved_count} files to {self.output_dir}")
+    
+    def _ensure_scp(self) -> bool:
+        """Start the storage SCP receiving C-MOVE images, unless already running"""
+        with self._scp_lock:
+            if self._scp is not None:
+                return True
             
-            if scp:
-                logger.info(f"Storage SCP started successfully on port {self.local_port}")
-            else:
-                logger.error("start_server returned None")
-                return False
+            try:
+                logger.info(f"Starting storage SCP on port {self.local_port}...")
+                self._scp = self.ae.start_server(
+                    ('0.0.0.0', self.local_port),  # Listen on all interfaces
+                    block=False,
+                    evt_handlers=[(evt.EVT_C_STORE, self.handle_store)]
+                )
                 
-        except Exception as e:
-            logger.error(f"Failed to start storage SCP on port {self.local_port}: {e}")
-            import traceback
-            logger.error(traceback.format_exc())
+                if self._scp:
+                    logger.info(f"Storage SCP started successfully on port {self.local_port}")
+                else:
+                    logger.error("start_server returned None")
+                    return False
+                    
+            except Exception as e:
+                logger.error(f"Failed to start storage SCP on port {self.local_port}: {e}")
+                import traceback
+                logger.error(traceback.format_exc())
+                return False
+            
+            return True
+    
+    def _retrieve_with_move(self, ds: Dataset) -> bool:
+        """Retrieve using C-MOVE (requires storage SCP)"""
+        # The storage SCP is started on the first C-MOVE and kept running
+        # until close()
+        if not self._ensure_scp():
             return False
         
         try:
             # Associate and send C-MOVE
-            from pynetdicom.sop_class import (
-                StudyRootQueryRetrieveInformationModelMove,
-                PatientRootQueryRetrieveInformationModelMove
-            )
-            
             move_model = (StudyRootQueryRetrieveInformationModelMove if self.use_study_root
                          else PatientRootQueryRetrieveInformationModelMove)
             
-            assoc = self.ae.associate(
-                self.pacs_host,
-                self.pacs_port,
-                ae_title=self.pacs_aet
-            )
+            assoc = self._ensure_assoc()
             
-            if assoc.is_established:
+            if assoc:
                 responses = assoc.send_c_move(
                     ds,
                     self.local_aet,  # Destination AET (ourselves)
@@ -506,11 +974,10 @@ class PACSNMRetriever:
                 
                 for status, identifier in responses:
                     if status:
-                        logger.debug(f"C-MOVE status: 0x{status.Status:04x}")
+                        logger.debug("C-MOVE status: 0x%04x", status.Status)
                         if status.Status in (0xA701, 0xA702, 0xA900, 0xC000):
                             logger.warning(f"C-MOVE warning/error status: 0x{status.Status:04x}")
                 
-                assoc.release()
                 return True
             else:
                 logger.error("Failed to associate for C-MOVE")
@@ -518,8 +985,25 @@ class PACSNMRetriever:
         except Exception as e:
             logger.error(f"Error during C-MOVE: {e}")
             return False
-        finally:
-            scp.shutdown()
+    
+    def close(self):
+        """Release associations with the PACS, stop the storage SCP and close the index"""
+        self._close_assocs()
+        with self._scp_lock:
+            if self._scp is not None:
+                self._scp.shutdown()
+                self._scp = None
+        with self._index_lock:
+            if self._index is not None:
+                self._index.commit()
+                self._index.close()
+                self._index = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
     
     def retrieve_images(
         self,
@@ -533,8 +1017,18 @@ class PACSNMRetriever:
             max_studies: Maximum number of studies to retrieve (None = all)
             max_images: Maximum number of images to retrieve (None = all)
         """
+        # Queries and C-MOVE requests reuse one association per thread
+        with _high_resolution_timer():
+            try:
+                self._retrieve_images(max_studies, max_images)
+            finally:
+                self._close_assocs()
+    
+    def _retrieve_images(self, max_studies: Optional[int], max_images: Optional[int]):
+        """Run a retrieval, releasing nothing: see retrieve_images"""
         # Find studies
-        studies = self.find_nm_studies(limit=max_studies, study_date=getattr(self, 'study_date', ''))
+        study_date = self._resolve_study_date(getattr(self, 'study_date', ''))
+        studies = self.find_nm_studies(limit=max_studies, study_date=study_date)
         
         if not studies:
             logger.warning("No NM studies found")
@@ -557,26 +1051,63 @@ class PACSNMRetriever:
         
         logger.info(f"Starting retrieval of {len(studies)} studies")
         
-        for idx, study in enumerate(studies, 1):
+        # Look up the series of all studies at once when the PACS allows it.
+        # Not when the studies are limited: that query covers the whole date range
+        series_by_study = None
+        if not self.dry_run and not max_studies:
+            series_by_study = self.find_nm_series_by_date(study_date)
+        
+        def retrieve(idx: int, study: Dataset):
+            # Studies still queued when the image limit is reached are skipped
+            if max_images and self.image_count >= max_images:
+                return
+            
             study_uid = study.StudyInstanceUID
             logger.info(f"Processing study {idx}/{len(studies)}: {study_uid}")
             
-            self.retrieve_study(study_uid)
-            
-            if max_images and self.image_count >= max_images:
-                logger.info(f"Reached image limit of {max_images}")
-                break
+            # Studies missing from the relational results (which the PACS may
+            # have truncated) have their series queried on their own
+            nm_series = series_by_study.get(study_uid) if series_by_study is not None else None
+            self.retrieve_study(study_uid, nm_series,
+                                study.get('NumberOfStudyRelatedInstances'))
+        
+        if self.max_parallel == 1:
+            # Keep going over the association the queries above used
+            for idx, study in enumerate(studies, 1):
+                retrieve(idx, study)
+        else:
+            # Each worker opens its own association: the one used by the
+            # queries above would otherwise stay open and idle
+            self._release_assoc()
+            with ThreadPoolExecutor(max_workers=self.max_parallel) as executor:
+                for future in [executor.submit(retrieve, idx, study)
+                               for idx, study in enumerate(studies, 1)]:
+                    future.result()
+        
+        if max_images and self.image_count >= max_images:
+            logger.info(f"Reached image limit of {max_images}")
         
         if self.dry_run:
             logger.info(f"[DRY-RUN] Would have retrieved approximately {self.image_count} images to {self.output_dir}")
         else:
             logger.info(f"Retrieval complete. Retrieved {self.image_count} images to {self.output_dir}")
         
-        # Count actual files
-        import os
+        # Count the images actually stored, under their PatientID/Study/Series
+        # directories (the index is not counted)
         if os.path.exists(self.output_dir):
-            total_files = len([f for f in os.listdir(self.output_dir) if os.path.isfile(os.path.join(self.output_dir, f))])
-            logger.info(f"Total files in output directory: {total_files}")
+            total_files = sum(
+                1 for _, _, filenames in os.walk(self.output_dir)
+                for filename in filenames if filename.endswith('.dcm')
+            )
+            logger.info(f"Total DICOM files in output directory: {total_files}")
+
+
+def _positive_int(value: str) -> int:
+    """argparse type for integers of at least 1"""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
 
 
 def main():
@@ -668,6 +1199,30 @@ Examples:
         action='store_true',
         help='Use C-MOVE instead of C-GET (requires network routing and storage SCP)'
     )
+    parser.add_argument(
+        '--use-dcmtk',
+        action='store_true',
+        help='Retrieve with DCMTK getscu instead of the built-in C-GET (fallback)'
+    )
+    parser.add_argument(
+        '--drop-page-cache',
+        action='store_true',
+        help='Sync each stored image to disk and drop it from the page cache '
+             '(less memory pressure on large retrievals, slower writes; Linux)'
+    )
+    parser.add_argument(
+        '--compress-on-store',
+        choices=list(_STORE_COMPRESSION),
+        default='none',
+        help='Losslessly compress images as they are stored: rle, j2k (needs pylibjpeg-openjpeg) '
+             'or none to keep the transfer syntax they were received in (default: none)'
+    )
+    parser.add_argument(
+        '--max-parallel',
+        type=_positive_int,
+        default=1,
+        help='Number of studies retrieved in parallel, each over its own association (default: 1)'
+    )
     parser.add_argument(
         '--patient-root',
         action='store_true',
@@ -697,17 +1252,24 @@ Examples:
         logging.getLogger().setLevel(logging.DEBUG)
     
     # Create retriever
-    retriever = PACSNMRetriever(
-        pacs_host=args.host,
-        pacs_port=args.port,
-        pacs_aet=args.aet,
-        local_aet=args.local_aet,
-        local_port=args.local_port,
-        output_dir=args.output,
-        use_study_root=not args.patient_root,  # Study Root is default
-        dry_run=args.dry_run,
-        use_c_get=not args.use_c_move  # C-GET is default
-    )
+    try:
+        retriever = PACSNMRetriever(
+            pacs_host=args.host,
+            pacs_port=args.port,
+            pacs_aet=args.aet,
+            local_aet=args.local_aet,
+            local_port=args.local_port,
+            output_dir=args.output,
+            use_study_root=not args.patient_root,  # Study Root is default
+            dry_run=args.dry_run,
+            use_c_get=not args.use_c_move,  # C-GET is default
+            max_parallel=args.max_parallel,
+            use_dcmtk=args.use_dcmtk,
+            compress_on_store=args.compress_on_store,
+            drop_page_cache=args.drop_page_cache
+        )
+    except ValueError as e:
+        parser.error(str(e))
     
     # Set study date if provided
     if args.from_date or args.to_date:
@@ -735,6 +1297,8 @@ Examples:
     except Exception as e:
         logger.error(f"Error during retrieval: {e}", exc_info=True)
         sys.exit(1)
+    finally:
+        retriever.close()
 
 
 if __name__ == '__main__':